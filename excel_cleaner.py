@@ -1,11 +1,218 @@
+import os
 import streamlit as st
-import pandas as pd
 import numpy as np
+import numexpr
+import pyarrow as pa
+from xlsxwriter.utility import xl_col_to_name
 import io
-import base64
+
+# Set IPP_USE_MODIN=1 on hosts that process very large sheets to run the pandas
+# steps on all cores through Modin. It is off by default: for typical uploads
+# Modin's scheduling overhead outweighs the parallel speed-up.
+if os.environ.get('IPP_USE_MODIN') == '1':
+    import modin.pandas as pd
+else:
+    import pandas as pd
 
 st.set_page_config(page_title="Excel Data Cleaner for IPP", layout="wide")
 
+# Storage backend for the text columns of the uploaded sheet
+DTYPE_BACKEND = 'pyarrow'
+
+# Rows sent to the browser for a table preview unless the user asks for all of them
+PREVIEW_ROWS = 200
+
+
+@st.cache_data
+def load_data(file_bytes: bytes) -> pd.DataFrame:
+    """Read the uploaded workbook. Cached on the file contents, so reruns skip the parse."""
+    # calamine parses both .xlsx and .xls in compiled code
+    df = pd.read_excel(io.BytesIO(file_bytes), engine='calamine')
+    # Store SKUs (Column A) as a categorical so grouping and de-duplication
+    # compare integer codes instead of Python strings
+    df[df.columns[0]] = df[df.columns[0]].astype('category')
+    # Back the remaining text columns with Arrow strings rather than NumPy object
+    # arrays. Numeric columns stay on NumPy for the numexpr steps below.
+    text_columns = df.select_dtypes(include='object').columns
+    df[text_columns] = df[text_columns].convert_dtypes(dtype_backend=DTYPE_BACKEND)
+    return df
+
+
+def sum_by_sku(skus: pd.Series, quantities: pd.Series) -> pd.Series:
+    """Sum quantities per SKU, returned as a Series indexed by SKU.
+
+    ``skus`` is the categorical SKU column, so the sum works on its integer
+    category codes and never compares SKU strings. Reports are usually
+    exported sorted by SKU, in which case every SKU already forms one
+    contiguous run of codes and np.add.reduceat sums all runs in a single
+    linear pass. Otherwise the codes are grouped by Arrow's hash aggregation
+    kernel. Rows without a SKU are ignored and blank quantities count as
+    zero, as in a groupby sum.
+    """
+    codes = skus.cat.codes.to_numpy()
+    present = codes >= 0
+    codes = codes[present]
+    quantity_values = quantities.fillna(0).to_numpy()[present]
+    
+    if len(codes) and (codes[1:] >= codes[:-1]).all():
+        # Index of the first row of each SKU run
+        starts = np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1))
+        sku_codes = codes[starts]
+        totals = np.add.reduceat(quantity_values, starts)
+    else:
+        sums = pa.table({'sku': codes, 'quantity': quantity_values}).group_by('sku').aggregate(
+            [('quantity', 'sum')]
+        )
+        sku_codes = sums['sku'].to_numpy()
+        totals = sums['quantity_sum'].to_numpy()
+    
+    # Keep the index categorical so the totals merge back onto the SKU column by code
+    index = pd.Categorical.from_codes(sku_codes, dtype=skus.dtype)
+    return pd.Series(totals, index=index, name='Total_Quantity_Values')
+
+
+@st.cache_data
+def process_data(file_bytes: bytes) -> tuple[pd.DataFrame, float]:
+    """Run the cleaning steps on the uploaded workbook.
+
+    Cached on the file contents, so reruns of the app return the processed
+    data and the total quantity without recomputing them.
+    """
+    # st.cache_data hands back its own copy of the loaded frame, and the steps
+    # below only ever derive new frames from it, so no extra copy is needed
+    df = load_data(file_bytes)
+    
+    # Step 1: Calculate total quantity sold per SKU (SUMIF equivalent)
+    # Assuming Column A contains SKU and Column E contains quantity
+    st.write("1. Calculating total quantity sold per SKU...")
+    
+    # Resolve the column names once from the original sheet layout, so later
+    # steps don't depend on positions shifting as columns are removed
+    columns = df.columns
+    sku_column = columns[0]  # Assuming A is the first column
+    column_d_name = columns[3]  # Assuming D is the fourth column
+    quantity_column = columns[4]  # Assuming E is the fifth column
+    column_g_name = columns[6] if len(columns) > 6 else None  # Column G, if present
+    
+    # Sum the quantities once per SKU; they are joined onto a single row per SKU
+    # in step 4, so the totals column only ever holds one value per product
+    totals = sum_by_sku(df[sku_column], df[quantity_column])
+    
+    # Step 2: Store the total quantity (sum of column E over the product rows)
+    # Summing the per-SKU totals avoids rescanning the column, and leaves out rows
+    # without a SKU (such as a trailing totals row) instead of counting them twice
+    total_quantity = totals.sum()
+    st.write(f"2. Total quantity from Column E: {total_quantity}")
+    
+    # Steps 3 and 4 only decide which rows and columns to keep; the frame is then
+    # cut down with a single selection instead of a new copy per step
+    
+    # Step 3: Clear rows past the last product line
+    # This is a bit tricky without knowing the exact format of "Totals & Applied Filters text"
+    # For now, we'll assume all valid data rows don't have NaN in critical columns
+    st.write("3. Clearing rows past the last product line...")
+    rows_to_keep = df[sku_column].notna().to_numpy()
+    
+    # Step 4: Remove columns D and E
+    st.write("4. Removing unnecessary columns...")
+    cols_to_keep = [col for col in columns if col not in (column_d_name, quantity_column)]
+    
+    processed_df = df.loc[rows_to_keep, cols_to_keep].drop_duplicates(subset=[sku_column]).merge(
+        totals, left_on=sku_column, right_index=True
+    )
+    
+    # Step 5: Calculate SKU Velocity
+    st.write("5. Calculating SKU Velocity...")
+    if column_g_name is not None:
+        # Evaluated as one numexpr expression rather than two temporary arrays. The
+        # column is passed in as a variable so any header text works, including
+        # '#', backticks, line breaks and numeric or date headers.
+        column_g = processed_df[column_g_name].to_numpy(dtype=np.float64)
+        processed_df['SKU_Velocity'] = numexpr.evaluate(
+            'column_g / total_quantity * 100',
+            local_dict={'column_g': column_g, 'total_quantity': total_quantity},
+        )
+    else:
+        st.warning("Column G not found. SKU Velocity calculation skipped.")
+    
+    # Step 6: Sort by SKU Velocity (largest to smallest)
+    st.write("6. Sorting by SKU Velocity...")
+    if 'SKU_Velocity' in processed_df.columns:
+        order = np.argsort(-processed_df['SKU_Velocity'].to_numpy(), kind='stable')
+        processed_df = processed_df.take(order)
+    
+    # Step 7: Highlight SKUs with 200+ units sold or 80% of sales volume
+    st.write("7. Identifying focus SKUs...")
+    if 'Total_Quantity_Values' in processed_df.columns and 'SKU_Velocity' in processed_df.columns:
+        quantities = processed_df['Total_Quantity_Values'].to_numpy()
+        velocities = processed_df['SKU_Velocity'].to_numpy()
+        
+        # Running share of sales volume, used to find the SKUs that make up 80% of it
+        cumulative_percentage = np.cumsum(velocities)
+        processed_df['Cumulative_Percentage'] = cumulative_percentage
+        
+        # Mark focus SKUs: 200+ units, or within the first 80% of sales volume.
+        # Velocities are sorted descending, so the non-negative ones form a prefix
+        # over which the running share never decreases, and the 80% cutoff is found
+        # by binary search inside it. Negative velocities (e.g. returns) follow and
+        # only pull the share back down, so if it never passes 80% within the prefix
+        # they are all included as well; blank (NaN) velocities sort last and never are.
+        non_negative = np.searchsorted(-velocities, 0, side='right')
+        volume_cutoff = np.searchsorted(cumulative_percentage[:non_negative], 80, side='right')
+        if volume_cutoff == non_negative:
+            volume_cutoff = np.searchsorted(-velocities, np.inf, side='right')
+        focus = quantities >= 200
+        focus[:volume_cutoff] = True
+        processed_df['Focus_SKU'] = focus
+    
+    return processed_df, total_quantity
+
+
+@st.cache_data
+def build_workbook(file_bytes: bytes, _processed_df: pd.DataFrame) -> bytes:
+    """Write the processed data to an xlsx workbook and return its bytes.
+
+    Cached on the uploaded file contents (the processed frame is derived from
+    them and is not hashed), so reruns such as download clicks or preview
+    toggles reuse the workbook instead of writing it again.
+    """
+    # The leading underscore tells st.cache_data not to hash the frame
+    processed_df = _processed_df
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        processed_df.to_excel(writer, index=False, sheet_name='Cleaned Data')
+        
+        # Try to access the active worksheet to apply formatting
+        try:
+            worksheet = writer.sheets['Cleaned Data']
+            last_row, last_col = len(processed_df), len(processed_df.columns) - 1
+            
+            # Apply filter to the header row
+            worksheet.autofilter(0, 0, last_row, last_col)
+            
+            # Highlight Focus SKUs with a single conditional format over the data rows,
+            # which Excel evaluates itself instead of us styling every cell
+            if 'Focus_SKU' in processed_df.columns and last_row > 0:
+                highlight_format = writer.book.add_format({'bg_color': '#FFFF00'})
+                focus_col = xl_col_to_name(processed_df.columns.get_loc('Focus_SKU'))
+                worksheet.conditional_format(1, 0, last_row, last_col, {
+                    'type': 'formula',
+                    'criteria': f'=${focus_col}2=TRUE',
+                    'format': highlight_format,
+                })
+        except Exception as e:
+            st.warning(f"Could not apply Excel formatting: {e}")
+    return buffer.getvalue()
+
+
+def show_preview(df: pd.DataFrame, key: str) -> None:
+    """Display the first PREVIEW_ROWS rows of a frame, with a checkbox to show all rows."""
+    if len(df) > PREVIEW_ROWS and not st.checkbox("Show all rows", key=key):
+        st.caption(f"Showing the first {PREVIEW_ROWS} of {len(df)} rows.")
+        df = df.head(PREVIEW_ROWS)
+    st.dataframe(df)
+
+
 st.title("Excel Data Cleaner for IPP")
 st.write("Upload your Excel file to clean and format it according to Retool requirements.")
 
@@ -15,133 +222,35 @@ uploaded_file = st.file_uploader("Choose an Excel file", type=["xlsx", "xls"])
 if uploaded_file is not None:
     # Load the Excel file
     try:
-        df = pd.read_excel(uploaded_file, engine='openpyxl')
+        file_bytes = uploaded_file.getvalue()
+        df = load_data(file_bytes)
         st.success("File successfully loaded!")
         
         # Display the original data
         st.subheader("Original Data")
-        st.dataframe(df)
+        show_preview(df, key='show_all_original')
         
-        # Process the data
+        # Process the data. The download button reruns the script, so remember
+        # which upload was processed to keep the results on screen afterwards.
         if st.button("Process Data"):
+            st.session_state['processed_file_id'] = uploaded_file.file_id
+        if st.session_state.get('processed_file_id') == uploaded_file.file_id:
             st.subheader("Processing...")
             
-            # Make a copy to avoid modifying the original
-            processed_df = df.copy()
-            
-            # Step 1: Calculate total quantity sold per SKU (SUMIF equivalent)
-            # Assuming Column A contains SKU and Column E contains quantity
-            st.write("1. Calculating total quantity sold per SKU...")
-            
-            # Get column names for clarity
-            sku_column = processed_df.columns[0]  # Assuming A is the first column
-            quantity_column = processed_df.columns[4]  # Assuming E is the fifth column
-            
-            # Create a new column I for the SUMIF equivalent
-            processed_df['Total_Quantity_Per_SKU'] = processed_df.apply(
-                lambda row: processed_df[processed_df[sku_column] == row[sku_column]][quantity_column].sum(), 
-                axis=1
-            )
-            
-            # Step 2: Copy this column as VALUES ONLY to column J
-            st.write("2. Copying totals as values only...")
-            processed_df['Total_Quantity_Values'] = processed_df['Total_Quantity_Per_SKU']
-            
-            # Step 3: Store the total quantity (sum of column E)
-            total_quantity = processed_df[quantity_column].sum()
-            st.write(f"3. Total quantity from Column E: {total_quantity}")
-            
-            # Step 4: Clear rows past the last product line
-            # This is a bit tricky without knowing the exact format of "Totals & Applied Filters text"
-            # For now, we'll assume all valid data rows don't have NaN in critical columns
-            st.write("4. Clearing rows past the last product line...")
-            processed_df = processed_df.dropna(subset=[sku_column], how='any')
-            
-            # Step 5: Remove columns D, E, and I
-            st.write("5. Removing unnecessary columns...")
-            # We'll keep track of which columns to drop
-            cols_to_drop = []
-            
-            # Check if we have enough columns to drop D and E
-            if len(processed_df.columns) > 4:
-                cols_to_drop.append(processed_df.columns[3])  # Column D (index 3)
-            if len(processed_df.columns) > 4:
-                cols_to_drop.append(processed_df.columns[4])  # Column E (index 4)
-            
-            # Drop the columns if we identified them
-            if cols_to_drop:
-                processed_df = processed_df.drop(columns=cols_to_drop)
-            
-            # We don't drop column I since we created it and it's now named 'Total_Quantity_Per_SKU'
-            processed_df = processed_df.drop(columns=['Total_Quantity_Per_SKU'])
-            
-            # Step 6: Remove duplicates in the Product Column (Column A)
-            st.write("6. Removing duplicates...")
-            processed_df = processed_df.drop_duplicates(subset=[sku_column])
-            
-            # Step 7: Calculate SKU Velocity
-            st.write("7. Calculating SKU Velocity...")
-            # Assume Column G is the 7th column (index 6)
-            if len(processed_df.columns) > 6:
-                column_g_name = processed_df.columns[6]
-                processed_df['SKU_Velocity'] = processed_df[column_g_name] / total_quantity * 100
-            else:
-                st.warning("Column G not found. SKU Velocity calculation skipped.")
-            
-            # Step 8: Sort by SKU Velocity (largest to smallest)
-            st.write("8. Sorting by SKU Velocity...")
-            if 'SKU_Velocity' in processed_df.columns:
-                processed_df = processed_df.sort_values(by='SKU_Velocity', ascending=False)
-            
-            # Step 9: Highlight SKUs with 200+ units sold or 80% of sales volume
-            st.write("9. Identifying focus SKUs...")
-            if 'Total_Quantity_Values' in processed_df.columns and 'SKU_Velocity' in processed_df.columns:
-                # Identify SKUs with 200+ units
-                high_unit_skus = processed_df[processed_df['Total_Quantity_Values'] >= 200]
-                
-                # Identify SKUs that make up 80% of sales volume
-                processed_df['Cumulative_Percentage'] = processed_df['SKU_Velocity'].cumsum()
-                volume_skus = processed_df[processed_df['Cumulative_Percentage'] <= 80]
-                
-                # Create a column to mark focus SKUs
-                processed_df['Focus_SKU'] = False
-                processed_df.loc[high_unit_skus.index, 'Focus_SKU'] = True
-                processed_df.loc[volume_skus.index, 'Focus_SKU'] = True
+            processed_df, total_quantity = process_data(file_bytes)
+            sku_column = processed_df.columns[0]  # Column A holds the SKU
             
             # Display the processed data
             st.subheader("Processed Data")
-            st.dataframe(processed_df)
-            
-            # Provide a download link for the processed data
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                processed_df.to_excel(writer, index=False, sheet_name='Cleaned Data')
-                
-                # Try to access the active worksheet to apply formatting
-                try:
-                    worksheet = writer.sheets['Cleaned Data']
-                    
-                    # Apply filter to the header row
-                    worksheet.auto_filter.ref = worksheet.dimensions
-                    
-                    # Highlight Focus SKUs
-                    if 'Focus_SKU' in processed_df.columns:
-                        from openpyxl.styles import PatternFill
-                        highlight_fill = PatternFill(start_color='FFFF00', end_color='FFFF00', fill_type='solid')
-                        
-                        for idx, row in enumerate(processed_df.itertuples(), start=2):  # Start from row 2 (after header)
-                            if row.Focus_SKU:
-                                for col in range(1, len(processed_df.columns) + 1):
-                                    worksheet.cell(row=idx, column=col).fill = highlight_fill
-                except Exception as e:
-                    st.warning(f"Could not apply Excel formatting: {e}")
+            show_preview(processed_df, key='show_all_processed')
             
-            buffer.seek(0)
-            
-            # Create download button
-            b64 = base64.b64encode(buffer.getvalue()).decode()
-            href = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" download="cleaned_data.xlsx">Download Processed Excel File</a>'
-            st.markdown(href, unsafe_allow_html=True)
+            # Provide a download button for the processed data
+            st.download_button(
+                "Download Processed Excel File",
+                data=build_workbook(file_bytes, processed_df),
+                file_name="cleaned_data.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
             
             # Display additional information
             st.subheader("Summary Statistics")
@@ -163,13 +272,11 @@ else:
 st.markdown("---")
 st.markdown("### Processing Steps:")
 st.markdown("""
-1. Calculate total quantity sold per SKU
-2. Copy totals as values only
-3. Store the total quantity
-4. Clear rows past the last product line
-5. Remove unnecessary columns
-6. Remove duplicates in the Product Column
-7. Calculate SKU Velocity (formula: quantity/total * 100)
-8. Sort by SKU Velocity (largest to smallest)
-9. Identify focus SKUs (200+ units sold or top SKUs comprising 80% of sales)
+1. Calculate total quantity sold per SKU (one row per product)
+2. Store the total quantity
+3. Clear rows past the last product line
+4. Remove unnecessary columns
+5. Calculate SKU Velocity (formula: quantity/total * 100)
+6. Sort by SKU Velocity (largest to smallest)
+7. Identify focus SKUs (200+ units sold or top SKUs comprising 80% of sales)
 """)